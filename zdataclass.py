@@ -4,6 +4,20 @@ import dataclasses
 from binascii import hexlify
 import logging
 import logging.config
+import time
+import asyncio
+import functools
+import math
+import copy
+import ctypes
+import struct
+import threading
+import concurrent.futures
+from collections import OrderedDict
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 try:
     logging.config.fileConfig('logging.conf')
@@ -20,26 +34,58 @@ TRACE_LEVEL_ERROR = 4
 LENGTH_FIELD = 'length' 
 DATA_FIELD = 'data'
 LENGTH_OFFSET = 'offset'
+# number of items of a bit_array field, int or name of the field holding it
+ITEM_COUNT = 'count'
 
 # A field with this decorator share same space with its following fields 
 UNION_FIELD = 'union'
 
+STRUCT_CODES = {1:'b', 2:'h', 4:'i', 8:'q'}
+
 class base_int(int):
     W = None
     ENDIAN = None
-    
+    SIGNED = False
+    # precomputed per subclass of whole bytes: encoder(value) -> bytes, decoder(data) -> value of subclass
+    encoder = None
+    decoder = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.encoder = None
+        cls.decoder = None
+        if cls.W == None or cls.ENDIAN == None or cls.W != int(cls.W):
+            return
+        W = int(cls.W)
+        if W in STRUCT_CODES:
+            code = STRUCT_CODES[W] if cls.SIGNED else STRUCT_CODES[W].upper()
+            s = struct.Struct(('<' if cls.ENDIAN == 'little' else '>') + code)
+            unpack_from = s.unpack_from
+            cls.encoder = staticmethod(s.pack)
+            cls.decoder = staticmethod(lambda data: cls(unpack_from(data)[0]))
+        else:
+            from_bytes = super(base_int, cls).from_bytes # returns object of cls
+            endian = cls.ENDIAN
+            signed = cls.SIGNED
+            cls.encoder = staticmethod(functools.partial(int.to_bytes, length=W, byteorder=endian, signed=signed))
+            cls.decoder = staticmethod(lambda data: from_bytes(data[0:W], endian, signed=signed))
+
     def to_bytes(self):
+        if self.encoder != None:
+            return self.encoder(self)
         if self.W == None or self.ENDIAN == None:
             raise Exception('object of type ({}) has no to_bytes()'.format(type(self)))
-        return int(self).to_bytes(self.W, self.ENDIAN)
+        return int(self).to_bytes(self.W, self.ENDIAN, signed=self.SIGNED)
 
     @classmethod
     def from_bytes(cls, data):
+        if cls.decoder != None:
+            return cls.decoder(data)
         if cls.ENDIAN == None:
             raise Exception('endian is unknown')
         if cls.W != None:
             data = data[0:cls.W]
-        return int.from_bytes(data, cls.ENDIAN)
+        return int.from_bytes(data, cls.ENDIAN, signed=cls.SIGNED)
 
     @classmethod    
     def __len__(cls):
@@ -48,37 +94,43 @@ class base_int(int):
         return cls.W
 
     def __repr__(self):
+        value = int(self)
+        raw = value & ((1 << int(self.W * 8)) - 1) if self.W != None and self.W == int(self.W) else value # two's complement
         if self.W == 1:
-            self.repr = '0x{:02x}({})'.format(self, self)
+            self.repr = '0x{:02x}({})'.format(raw, value)
         elif self.W == 2:
-            self.repr = '0x{:04x}({})'.format(self, self)
+            self.repr = '0x{:04x}({})'.format(raw, value)
         elif self.W == 3:
-            self.repr = '0x{:06x}({})'.format(self, self)
+            self.repr = '0x{:06x}({})'.format(raw, value)
         elif self.W == 4:
-            self.repr = '0x{:08x}({})'.format(self, self)
+            self.repr = '0x{:08x}({})'.format(raw, value)
         elif self.W == 8:
-            self.repr = '0x{:016x}({})'.format(self, self)
+            self.repr = '0x{:016x}({})'.format(raw, value)
         elif self.W == 16:
-            self.repr = '0x{:032x}({})'.format(self, self)
+            self.repr = '0x{:032x}({})'.format(raw, value)
         else:
-            self.repr = '{}'.format(self)
+            self.repr = '{}'.format(value)
         return self.repr
 
 class int8(base_int): 
     W = 1
     ENDIAN = 'little'
+    SIGNED = True
 
 class int16(base_int):    
     W = 2
     ENDIAN = 'little'
+    SIGNED = True
 
 class int24(base_int):    
     W = 3
     ENDIAN = 'little'    
+    SIGNED = True
 
 class int32(base_int):    
     W = 4
     ENDIAN = 'little'
+    SIGNED = True
 
 class uint8(base_int):    
     W = 1
@@ -277,6 +329,181 @@ class uint16_array(int_array):
 class uint32_array(int_array):   
     W=4
     ENDIAN = 'little'
+
+# minimal number of items before the numpy path is used for bulk encode/decode
+BIT_ARRAY_NUMPY_THRESHOLD = 256
+
+def bit_array_layout(bits):
+    # word used for bulk access: a whole number of items and bytes, up to 64 bits if possible
+    unit = bits * 8 // math.gcd(bits, 8)
+    word_bits = unit * max(1, 64 // unit)
+    return word_bits // 8, range(0, word_bits, bits)
+
+# all subclasses of bit_array, see ITEM_COUNT
+bit_array_types = set()
+
+class bit_array():
+    # array of packed sub-byte items, item i occupies bits [i*BITS, (i+1)*BITS) LSB first
+    BITS = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        bit_array_types.add(cls)
+
+    def __init__(self, array=None, n_items=None):
+        if self.BITS == None:
+            raise Exception('object of type ({}) has no item width'.format(type(self)))
+        if type(array) in [bytes, bytearray, memoryview]:
+            self.data = bytearray(array)
+            # without item count, padding bits of last byte are taken as items
+            self.n_items = len(self.data) * 8 // self.BITS
+            if n_items != None:
+                self.n_items = min(n_items, self.n_items)
+        elif isinstance(array, bit_array):
+            self.data = bytearray(array.data)
+            self.n_items = array.n_items
+        elif array is not None:
+            self.array = array
+        else:
+            self.data = bytearray()
+            self.n_items = 0
+
+    @property
+    def array(self):
+        return self.decode(self.data, self.n_items)
+
+    @array.setter
+    def array(self, values):
+        values = values.tolist() if hasattr(values, 'tolist') else list(values) # numpy array to ints
+        self.data = self.encode(values)
+        self.n_items = len(values)
+
+    @classmethod
+    def decode(cls, data, n_items):
+        B = cls.BITS
+        mask = (1 << B) - 1
+        if numpy != None and n_items >= BIT_ARRAY_NUMPY_THRESHOLD:
+            bits = numpy.unpackbits(numpy.frombuffer(bytes(data), dtype=numpy.uint8), bitorder='little')
+            bits = bits[0:n_items*B].reshape(n_items, B).astype(numpy.uint32)
+            return bits.dot(numpy.left_shift(1, numpy.arange(B, dtype=numpy.uint32))).tolist()
+        word_bytes, shifts = bit_array_layout(B)
+        values = []
+        for start in range(0, (n_items*B + 7) // 8, word_bytes):
+            word = int.from_bytes(data[start:start+word_bytes], 'little')
+            values.extend([(word >> s) & mask for s in shifts])
+        del values[n_items:]
+        return values
+
+    @classmethod
+    def encode(cls, values):
+        B = cls.BITS
+        mask = (1 << B) - 1
+        n_bytes = (len(values)*B + 7) // 8
+        if numpy != None and len(values) >= BIT_ARRAY_NUMPY_THRESHOLD:
+            items = numpy.asarray(values, dtype=numpy.uint32) & mask
+            bits = (items[:, None] >> numpy.arange(B, dtype=numpy.uint32)) & 1
+            return bytearray(numpy.packbits(bits.astype(numpy.uint8).reshape(-1), bitorder='little').tobytes())
+        word_bytes, shifts = bit_array_layout(B)
+        n = len(shifts)
+        data = bytearray()
+        for i in range(0, len(values), n):
+            word = 0
+            for s, v in zip(shifts, values[i:i+n]):
+                word |= (int(v) & mask) << s
+            data += word.to_bytes(word_bytes, 'little')
+        del data[n_bytes:]
+        return data
+
+    def to_bytes(self):
+        n_bits = self.n_items * self.BITS
+        data = bytes(self.data[0:(n_bits + 7) // 8])
+        if n_bits & 7: # clear padding bits of last byte
+            data = data[:-1] + bytes([data[-1] & ((1 << (n_bits & 7)) - 1)])
+        return data
+
+    @classmethod
+    def from_bytes(cls, data, n_items=None):
+        # keep items packed, they are decoded on access
+        return cls(bytearray(data), n_items)
+
+    def index(self, i):
+        if i < 0:
+            i += self.n_items
+        if i < 0 or i >= self.n_items:
+            raise IndexError('bit_array index out of range')
+        bit = i * self.BITS
+        return bit >> 3, (bit + self.BITS + 7) >> 3, bit & 7
+
+    def __getitem__(self, i):
+        start, end, shift = self.index(i)
+        return (int.from_bytes(self.data[start:end], 'little') >> shift) & ((1 << self.BITS) - 1)
+
+    def __setitem__(self, i, value):
+        start, end, shift = self.index(i)
+        mask = (1 << self.BITS) - 1
+        word = int.from_bytes(self.data[start:end], 'little')
+        word = (word & ~(mask << shift)) | ((value & mask) << shift)
+        self.data[start:end] = word.to_bytes(end - start, 'little')
+
+    def __iter__(self):
+        return iter(self.array)
+
+    def __len__(self): # length in bytes
+        return (self.n_items * self.BITS + 7) // 8
+
+    def __eq__(self, other):
+        if type(other) != type(self):
+            return False
+        return self.n_items == other.n_items and self.to_bytes() == other.to_bytes()
+
+    def __repr__(self):
+        self.repr = 'array[{}]:'.format(self.n_items)
+        if self.n_items:
+            self.repr += '\r\n' + ' '.join('{:x}'.format(x) for x in self.array)
+        self.repr += '\r\n'
+        return self.repr
+
+class uint1_array(bit_array):
+    BITS = 1
+
+class uint2_array(bit_array):
+    BITS = 2
+
+class uint3_array(bit_array):
+    BITS = 3
+
+class uint4_array(bit_array):
+    BITS = 4
+
+class uint5_array(bit_array):
+    BITS = 5
+
+class uint6_array(bit_array):
+    BITS = 6
+
+class uint7_array(bit_array):
+    BITS = 7
+
+class uint9_array(bit_array):
+    BITS = 9
+
+class uint10_array(bit_array):
+    BITS = 10
+
+class uint11_array(bit_array):
+    BITS = 11
+
+class uint12_array(bit_array):
+    BITS = 12
+
+class uint13_array(bit_array):
+    BITS = 13
+
+class uint14_array(bit_array):
+    BITS = 14
+
+class uint15_array(bit_array):
+    BITS = 15
 	
 class type_len_data_t():
     def __len__(self): # including size field
@@ -307,6 +534,54 @@ class type_len_data_t():
             self.array.append(int.from_bytes(data[idx: idx+W], self.ENDIAN))
         return self
 
+class decode_cache_t():
+    # LRU cache of decoded results keyed on input bytes, safe to share between threads
+    MISS = object()
+
+    def __init__(self, maxsize=128, max_key_size=4096):
+        self.maxsize = maxsize
+        self.max_key_size = max_key_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, self.MISS)
+            if entry is self.MISS:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        return {'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions,
+                'size':len(self.entries), 'maxsize':self.maxsize}
+
+def copy_field_value(value):
+    # values shared with a decode cache entry are copied unless immutable
+    if value == None or type(value) in [bytes, str] or isinstance(value, int) or getattr(value, 'frozen', False):
+        return value
+    return copy.deepcopy(value)
+
 # sdp data element
 # byte[0].bit[7:3] element type
 class data_element_type(IntEnum):
@@ -333,12 +608,53 @@ class data_element_size_t(IntEnum):
     IN_NEXT_U32 = 7  
     
 class sdp_data_element_t():
+    # see enable_decode_cache()
+    decode_cache = None
+
     def __init__(self, element_type=None, element_size=None, element_data=None):
         self.element_type = element_type
         if element_size !=None:
             self.set_element_size(element_size)
         self.element_data = element_data
 
+    # see freeze()
+    frozen = False
+
+    def freeze(self):
+        # make element read-only, by becoming a frozen_sdp_data_element_t
+        if self.frozen:
+            return self
+        if type(self.element_data) == list:
+            self.element_data = tuple(ele.freeze() for ele in self.element_data)
+        elif type(self.element_data) in [bytearray, memoryview]:
+            self.element_data = bytes(self.element_data)
+        self.__class__ = frozen_sdp_data_element_t
+        return self
+
+    @classmethod
+    def enable_decode_cache(cls, maxsize=128, max_key_size=4096):
+        # Top level from_bytes() calls are cached. The decoded element is still filled in self,
+        # its sub-elements are frozen and shared by all callers decoding same bytes.
+        cls.decode_cache = decode_cache_t(maxsize, max_key_size)
+        return cls.decode_cache
+
+    @classmethod
+    def disable_decode_cache(cls):
+        cls.decode_cache = None
+
+    @staticmethod
+    def element_len(data):
+        # total length of the element starting at data[0], from its header only
+        size_desc = data[0] & 0x07
+        if size_desc <= data_element_size_t.SIXTEEN:
+            return (1 <<size_desc) + 1
+        elif size_desc == data_element_size_t.IN_NEXT_U8:
+            return data[1] + 2
+        elif size_desc == data_element_size_t.IN_NEXT_U16:
+            return int.from_bytes(data[1:3], 'big') + 3
+        else:
+            return int.from_bytes(data[1:5], 'big') + 5
+
     def set_element_size(self, element_size):
         self.element_size = element_size
         if element_size == 1:
@@ -386,6 +702,32 @@ class sdp_data_element_t():
         return data
 
     def from_bytes(self, data):
+        cache = sdp_data_element_t.decode_cache
+        if cache == None or len(data) == 0:
+            return self.decode(data)
+        n = self.element_len(data)
+        if n > cache.max_key_size:
+            return self.decode(data)
+        key = bytes(data[0:n])
+        entry = cache.get(key)
+        if entry is decode_cache_t.MISS:
+            self.decode(key)
+            entry = sdp_data_element_t()
+            entry.copy_from(self)
+            cache.put(key, entry.freeze())
+        self.copy_from(entry)
+        return self
+
+    def copy_from(self, other):
+        self.element_type = other.element_type
+        self.element_size_desc = other.element_size_desc
+        self.element_size = other.element_size
+        if type(other.element_data) in [list, tuple]:
+            self.element_data = list(other.element_data)
+        else:
+            self.element_data = other.element_data
+
+    def decode(self, data):
         if len(data) == 0:
             self.element_type = data_element_type.NULL
             self.element_size_desc = 0
@@ -422,7 +764,7 @@ class sdp_data_element_t():
             count = self.element_size
             self.element_data = []
             while count >0:
-                ele = sdp_data_element_t().from_bytes(data[offset:])
+                ele = sdp_data_element_t().decode(data[offset:])
                 offset += len(ele)
                 count -= len(ele)
                 self.element_data.append(ele)
@@ -453,17 +795,129 @@ class sdp_data_element_t():
         self.repr = format_str
         return self.repr        
 
+class frozen_sdp_data_element_t(sdp_data_element_t):
+    # sdp data element shared by the decode cache
+    frozen = True
+
+    def __setattr__(self, name, value):
+        if name != 'repr':
+            raise AttributeError('data element is read-only, it is shared by the decode cache')
+        object.__setattr__(self, name, value)
+
+class sdp_record_view_t():
+    # Lazy view of a raw sdp service record, a DATA_ELEMENT_SEQ of <attribute id, attribute value>.
+    # Only element headers are scanned to index attributes, a value is decoded when it is looked up.
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.index = None
+        self.values = {}
+
+    def build_index(self):
+        if self.index != None:
+            return self.index
+        data = self.data
+        if len(data) == 0 or data[0] >>3 != data_element_type.DATA_ELEMENT_SEQ:
+            raise Exception('sdp record shall be a data element sequence')
+        end = sdp_data_element_t.element_len(data)
+        offset = end - self.seq_size(data)
+        if end > len(data):
+            raise Exception('sdp record length {} less than expected {}'.format(len(data), end))
+        index = {}
+        while offset < end:
+            # attribute id is an uint16 data element
+            if offset + 3 > end or data[offset] != (data_element_type.UINT <<3) | data_element_size_t.TWO:
+                raise Exception('bad attribute id element at offset {}'.format(offset))
+            attr_id = int.from_bytes(data[offset+1:offset+3], 'big')
+            offset += 3
+            # a truncated header gives a length beyond end too
+            n = sdp_data_element_t.element_len(data[offset:end]) if offset < end else 0
+            if n == 0 or offset + n > end:
+                raise Exception('bad attribute value element at offset {}'.format(offset))
+            index[attr_id] = (offset, n)
+            offset += n
+        self.index = index
+        return index
+
+    @staticmethod
+    def seq_size(data):
+        size_desc = data[0] & 0x07
+        if size_desc == data_element_size_t.IN_NEXT_U8:
+            return data[1]
+        elif size_desc == data_element_size_t.IN_NEXT_U16:
+            return int.from_bytes(data[1:3], 'big')
+        elif size_desc == data_element_size_t.IN_NEXT_U32:
+            return int.from_bytes(data[1:5], 'big')
+        return 1 <<size_desc
+
+    def attribute_ids(self):
+        return list(self.build_index().keys())
+
+    def raw(self, attr_id):
+        offset, n = self.build_index()[attr_id]
+        return bytes(self.data[offset:offset+n])
+
+    def get(self, attr_id, default=None):
+        if attr_id not in self.build_index():
+            return default
+        value = self.values.get(attr_id)
+        if value == None:
+            value = sdp_data_element_t().from_bytes(self.raw(attr_id))
+            self.values[attr_id] = value
+        return value
+
+    def __getitem__(self, attr_id):
+        if attr_id not in self.build_index():
+            raise KeyError(attr_id)
+        return self.get(attr_id)
+
+    def __contains__(self, attr_id):
+        return attr_id in self.build_index()
+
+    def __len__(self):
+        return len(self.build_index())
+
+CTYPES_UINT = {1:ctypes.c_uint8, 2:ctypes.c_uint16, 4:ctypes.c_uint32, 8:ctypes.c_uint64}
+CTYPES_INT = {1:ctypes.c_int8, 2:ctypes.c_int16, 4:ctypes.c_int32, 8:ctypes.c_int64}
+STRUCT_UINT = {1:'B', 2:'H', 4:'I', 8:'Q'}
+
+def fixed_enum_width(t):
+    if not isinstance(t, type):
+        return None
+    if issubclass(t, (IntEnum8, IntFlag8)):
+        return 1
+    if issubclass(t, (IntEnum16, IntFlag16)):
+        return 2
+    if issubclass(t, IntFlag32):
+        return 4
+    return None
+
 @dataclass
 class basedataclass:    
+    # see enable_decode_cache()
+    decode_cache = None
+    # see ctypes_struct()
+    ctypes_type = None
+    # see enable_packed_identity()
+    packed_identity = False
+
     def __post_init__(self):
         self.trace_level = TRACE_LEVEL_NONE
+        # An item count field is initialized with number of items of its bit_array field
+        for x in dataclasses.fields(self):
+            count_field = getattr(x, 'metadata').get(ITEM_COUNT, None)
+            value = getattr(self, getattr(x, 'name'))
+            if type(count_field) == str and value is not None:
+                if type(value) != getattr(x, 'type'):
+                    value = getattr(x, 'type')(value)
+                    setattr(self, getattr(x, 'name'), value)
+                setattr(self, count_field, value.n_items)
         # Deal with special fields from tail to head. A field is union and <length, value> type 
         for x in dataclasses.fields(self)[::-1]: 
             fieldname = getattr(x, 'name')
             # A length field is initialized with length of its data-field
             data_field = self.is_length_field(x)
             if data_field != None: 
-                setattr(self, fieldname, len(getattr(self,data_field)))
+                setattr(self, fieldname, self.get_length_value(data_field, len(getattr(self,data_field))))
 
             # A union field shall be bytearray and be packed with its following fields
             self.bit_offset = 0
@@ -559,6 +1013,12 @@ class basedataclass:
 
         return length
     
+    def get_item_count(self, x):
+        n_items = getattr(x, 'metadata').get(ITEM_COUNT, None)
+        if type(n_items) == str:
+            n_items = getattr(self, n_items)
+        return None if n_items == None else int(n_items)
+
     def get_field_len(self, x, data=None):
         t = getattr(x, 'type')
         # length determined by field type, shall be first check
@@ -573,6 +1033,10 @@ class basedataclass:
         m = self.get_field_len_from_metadata(x)
         if m !=None:
             return m
+        if t in bit_array_types:
+            n_items = self.get_item_count(x)
+            if n_items != None:
+                return (n_items * t.BITS + 7) // 8
 
         # length determined by field (default) value
         fieldname = getattr(x, 'name')
@@ -670,24 +1134,108 @@ class basedataclass:
             print(s)
               
     def pack(self):
+        return bytes(self.pack_into(bytearray()))
+
+    # so that a basedataclass can be field of another one
+    def to_bytes(self):
+        return self.pack()
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls().unpack(data)
+
+    def get_length_offset(self, x):
+        offset = getattr(x, 'metadata').get(LENGTH_OFFSET, 0)
+        if type(offset) == str:
+            offset = getattr(self, offset)
+        return offset if isinstance(offset, int) else 0
+
+    def get_length_value(self, data_field, n):
+        # value of the length field of data_field which is n bytes long, see LENGTH_OFFSET
+        return n - self.get_length_offset(self.__dataclass_fields__[data_field])
+
+    def pack_into(self, buf):
+        # Pack all fields at the end of bytearray buf in one pass. Length fields are written as
+        # placeholders and back-patched once their data field is in buf, a union field which is
+        # not the last field spans all its following fields.
         self.bit_offset = 0
         self.bitfields = []
-        data = b''
         self.info('pack {}'.format(type(self)))
-        for x in dataclasses.fields(self):
+        fields = dataclasses.fields(self)
+        positions = []
+        groups = {} # bitfield name -> (position, bitfields of its group)
+        counts = {} # item count field name -> bit_array field name
+        for x in fields:
+            count_field = getattr(x, 'metadata').get(ITEM_COUNT, None)
+            if type(count_field) == str:
+                counts[count_field] = x.name
+        for x in fields:
+            positions.append(len(buf))
             fieldtype = getattr(x, 'type')
+            fieldname = getattr(x, 'name')
+            value = getattr(self, fieldname)
             if fieldtype in base_int.__subclasses__() and fieldtype.W !=int(fieldtype.W):
-                fieldname = getattr(x, 'name')
-                value = getattr(self, fieldname)
+                if self.is_length_field(x) != None or fieldname in counts:
+                    value = 0 # placeholder
                 self.bit_offset += int(fieldtype.W * 8)
-                self.bitfields.append((int(fieldtype.W * 8), value))
+                self.bitfields.append((int(fieldtype.W * 8), value, fieldname))
                 if self.bit_offset & 7 == 0:
-                    data += self.pack_bitfields(self.bitfields)
+                    for bitfield in self.bitfields:
+                        groups[bitfield[2]] = (len(buf), self.bitfields)
+                    buf += self.pack_bitfields(self.bitfields)
                     self.bit_offset = 0
                     self.bitfields = []
+            elif self.is_length_field(x) != None or fieldname in counts:
+                buf += bytes(int(self.get_field_len(x)))
+            elif isinstance(value, basedataclass):
+                value.pack_into(buf)
             else:
-                data += self.pack_field(x)
-        return data
+                buf += self.pack_field(x)
+
+        # span of each field in buf
+        spans = {}
+        for i, x in enumerate(fields):
+            if i == len(fields) - 1 or self.is_union_field(x):
+                end = len(buf)
+            else:
+                end = positions[i+1]
+            spans[x.name] = (positions[i], end)
+
+        for i, x in enumerate(fields):
+            data_field = self.is_length_field(x)
+            if data_field == None:
+                continue
+            start, end = spans[data_field]
+            value = getattr(x, 'type')(self.get_length_value(data_field, end - start))
+            setattr(self, x.name, value)
+            self.patch_field(buf, x, value, positions[i], groups)
+
+        for i, x in enumerate(fields):
+            array_field = counts.get(x.name)
+            if array_field == None:
+                continue
+            value = getattr(x, 'type')(getattr(self, array_field).n_items)
+            setattr(self, x.name, value)
+            self.patch_field(buf, x, value, positions[i], groups)
+
+        # union fields are refreshed from what was packed
+        for i, x in enumerate(fields[:-1]):
+            if self.is_union_field(x) and getattr(x, 'type') in [bytearray, bytes]:
+                start, end = spans[x.name]
+                setattr(self, x.name, getattr(x, 'type')(buf[start:end]))
+        return buf
+
+    def patch_field(self, buf, x, value, position, groups):
+        # overwrite packed value of field x, a bitfield is patched by repacking its group
+        group = groups.get(x.name)
+        if group == None:
+            data = value.to_bytes()
+            buf[position:position+len(data)] = data
+            return
+        position, bitfields = group
+        bitfields[:] = [(b[0], value, b[2]) if b[2] == x.name else b for b in bitfields]
+        data = self.pack_bitfields(bitfields)
+        buf[position:position+len(data)] = data
 
     def unpack_bitfields(self, bitfields, data):
         offset = 0
@@ -734,7 +1282,9 @@ class basedataclass:
                 value = data[offset:offset+L]
             else:
                 try:
-                    if t != sdp_data_element_t:
+                    if t in bit_array_types:
+                        value = t.from_bytes(data[offset:offset+L], self.get_item_count(x))
+                    elif t != sdp_data_element_t:
                         value = t.from_bytes(data[offset:offset+L])
                     else:
                         value = sdp_data_element_t().from_bytes(data[offset:])
@@ -763,7 +1313,43 @@ class basedataclass:
         self.info('unpack succeed {}'.format(type(self)))
         return self
     
+    @classmethod
+    def enable_decode_cache(cls, maxsize=128, max_key_size=4096):
+        # unpack() of this class (not its subclasses) looks up results by input bytes
+        cls.decode_cache = decode_cache_t(maxsize, max_key_size)
+        return cls.decode_cache
+
+    @classmethod
+    def disable_decode_cache(cls):
+        cls.decode_cache = None
+
+    def unpack_cached(self, cache, data):
+        key = bytes(data)
+        entry = cache.get(key)
+        if entry is decode_cache_t.MISS:
+            ret = self.unpack1_safe(data)
+            if ret == None:
+                entry = None
+            else:
+                entry = {x.name: copy_field_value(getattr(self, x.name)) for x in dataclasses.fields(self)}
+            cache.put(key, entry)
+            return ret
+        if entry == None:
+            return None
+        for name, value in entry.items():
+            setattr(self, name, copy_field_value(value))
+        return self
+
     def unpack(self, data):
+        cache = type(self).__dict__.get('decode_cache')
+        if cache != None and len(data) <= cache.max_key_size:
+            try:
+                return self.unpack_cached(cache, data)
+            except Exception as e:
+                return None
+        return self.unpack1_safe(data)
+
+    def unpack1_safe(self, data):
         ''''ret = self.unpack1(data, endian, dbg_en)
         return ret'''
         try:
@@ -794,6 +1380,506 @@ class basedataclass:
                 return False
         return True
 
+    @classmethod
+    def enable_packed_identity(cls):
+        # __eq__/__hash__ of this class compare the packed bytes, which are cached until a field is set.
+        # A field value changed in place (e.g. a bytearray) needs invalidate_packed().
+        cls.packed_identity = True
+        cls.__eq__ = basedataclass.packed_eq
+        cls.__hash__ = basedataclass.packed_hash
+        cls.__setattr__ = basedataclass.packed_setattr
+
+    def packed_setattr(self, name, value):
+        if name in self.__dataclass_fields__:
+            self.__dict__.pop('packed_cache', None)
+        object.__setattr__(self, name, value)
+
+    def invalidate_packed(self):
+        self.__dict__.pop('packed_cache', None)
+
+    def canonical_bytes(self):
+        if not self.packed_identity:
+            return self.pack()
+        data = self.__dict__.get('packed_cache')
+        if data == None:
+            data = self.pack()
+            self.packed_cache = data
+        return data
+
+    def packed_eq(self, other):
+        if other.__class__ != self.__class__:
+            return NotImplemented
+        try:
+            return self.canonical_bytes() == other.canonical_bytes()
+        except Exception:
+            # e.g. a field is not set yet, compare fields like dataclass __eq__
+            return self.field_values() == other.field_values()
+
+    def packed_hash(self):
+        # an object which cannot be packed (e.g. a field is not set) only hashes its class,
+        # it is equal to no object which can be packed
+        try:
+            return hash(self.canonical_bytes())
+        except Exception:
+            return hash(self.__class__)
+
+    def field_values(self):
+        return tuple(getattr(self, x.name) for x in dataclasses.fields(self))
+
+    @classmethod
+    def fixed_layout(cls):
+        # [(fieldname, n_bits or None, n_bytes, ctype)] for a class whose layout is fully known from
+        # field types and constant LENGTH_FIELD metadata. A bitfield group is one item with
+        # fieldname None and a list of (fieldname, n_bits) as ctype.
+        fields = dataclasses.fields(cls)
+        layout = []
+        bitfields = []
+        bit_offset = 0
+        endian = None
+        for x in fields:
+            t = getattr(x, 'type')
+            fieldname = getattr(x, 'name')
+            metadata = getattr(x, 'metadata')
+            if metadata.get(UNION_FIELD, False) and x != fields[-1]:
+                continue
+            if t in base_int.__subclasses__() and t.W != int(t.W):
+                bitfields.append((fieldname, int(t.W * 8)))
+                bit_offset += int(t.W * 8)
+                if bit_offset & 7 == 0:
+                    if bit_offset // 8 not in CTYPES_UINT:
+                        raise Exception('bitfields of {} bits has no fixed layout'.format(bit_offset))
+                    layout.append((None, bit_offset // 8, bitfields))
+                    bitfields = []
+                    bit_offset = 0
+                continue
+            if bitfields:
+                raise Exception('bitfields before field {} are not byte aligned'.format(fieldname))
+
+            length = metadata.get(LENGTH_FIELD, None)
+            if t in base_int.__subclasses__():
+                W = int(t.W)
+                if endian != None and t.ENDIAN != endian and W > 1:
+                    raise Exception('field {} of {} has mixed endian'.format(fieldname, cls))
+                if W > 1:
+                    endian = t.ENDIAN
+                layout.append((fieldname, W, (CTYPES_INT if t.SIGNED else CTYPES_UINT).get(W, None)))
+            elif fixed_enum_width(t) != None:
+                W = fixed_enum_width(t)
+                layout.append((fieldname, W, CTYPES_UINT[W]))
+            elif type(length) == int and issubclass(t, int_array) and t.W in CTYPES_UINT:
+                if endian != None and t.ENDIAN != endian and t.W > 1:
+                    raise Exception('field {} of {} has mixed endian'.format(fieldname, cls))
+                if t.W > 1:
+                    endian = t.ENDIAN
+                layout.append((fieldname, length, CTYPES_UINT[t.W] * (length // t.W)))
+            elif type(length) == int and (t in [bytearray, bytes] or issubclass(t, bit_array)):
+                layout.append((fieldname, length, None))
+            else:
+                raise Exception('field {} of {} has no fixed layout'.format(fieldname, cls))
+        if bitfields:
+            raise Exception('bitfields of {} are not byte aligned'.format(cls))
+        if endian == 'big' and any(x[0] == None for x in layout):
+            # bitfields are always packed from bit 0 of a little endian word
+            raise Exception('bitfields of big endian {} have no ctypes layout'.format(cls))
+        return endian or 'little', layout
+
+    @classmethod
+    def ctypes_struct(cls):
+        # ctypes structure with same layout, e.g. cls.ctypes_struct().from_buffer(mmap_obj, offset)
+        struct_type = cls.__dict__.get('ctypes_type')
+        if struct_type != None:
+            return struct_type
+        endian, layout = cls.fixed_layout()
+        ctypes_fields = []
+        for fieldname, n, ctype in layout:
+            if fieldname == None:
+                ctypes_fields += [(name, CTYPES_UINT[n], n_bits) for name, n_bits in ctype]
+            elif ctype == None:
+                ctypes_fields.append((fieldname, ctypes.c_uint8 * n))
+            else:
+                ctypes_fields.append((fieldname, ctype))
+        base = ctypes.LittleEndianStructure if endian == 'little' else ctypes.BigEndianStructure
+        struct_type = type(cls.__name__ + '_ctypes', (base,), {'_pack_':1, '_fields_':ctypes_fields})
+        cls.ctypes_type = struct_type
+        return struct_type
+
+    @classmethod
+    def struct_format(cls):
+        # struct module format, a bitfield group is one integer and a 3 or 16 byte integer is a bytes item
+        endian, layout = cls.fixed_layout()
+        fmt = '<' if endian == 'little' else '>'
+        for fieldname, n, ctype in layout:
+            if fieldname == None or (ctype in CTYPES_UINT.values()):
+                fmt += STRUCT_UINT[n]
+            elif ctype in CTYPES_INT.values():
+                fmt += STRUCT_CODES[n]
+            elif ctype == None:
+                fmt += '{}s'.format(n)
+            else:
+                fmt += '{}{}'.format(ctype._length_, STRUCT_UINT[ctypes.sizeof(ctype._type_)])
+        return fmt
+
+    @classmethod
+    def from_buffer(cls, buf, offset=0):
+        # in place view of a record in a writable buffer (bytearray, mmap, shared memory)
+        return cls.ctypes_struct().from_buffer(buf, offset)
+
+def dedup(items):
+    # yield items in order, skipping those with same class and packed bytes as an earlier one
+    seen = set()
+    for x in items:
+        key = (x.__class__, x.canonical_bytes())
+        if key not in seen:
+            seen.add(key)
+            yield x
+
+def bitfield_names(bitfields):
+    # bitfields are (n_bits, fieldname, default) when unpacking, (n_bits, value[, fieldname]) when packing
+    names = [x[1] if type(x[1]) == str else (x[2] if len(x) > 2 else '?') for x in bitfields]
+    return '+'.join(names)
+
+class field_profiler_t():
+    # Cumulative time and call count per (class, field, operation) of pack/unpack. Profiled methods
+    # are swapped in by enable() and restored by disable(), so normal pack/unpack is not affected.
+    # Times are inclusive, e.g. ('*', 'unpack') of a class includes all its fields. Field values
+    # are decoded inline by unpack1(), their decoding is timed per field type ('*', 'from_bytes').
+    # with field_profiler_t() as prof:
+    #     workload()
+    # print(prof.report())
+    active = None
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.originals = []
+
+    def add(self, key, elapsed):
+        with self.lock: # pack/unpack may run in several threads, e.g. decode_pipeline_t
+            entry = self.stats.get(key)
+            if entry == None:
+                self.stats[key] = [1, elapsed]
+            else:
+                entry[0] += 1
+                entry[1] += elapsed
+
+    def wrap(self, cls, method, key):
+        # replace method (or classmethod) by a timed one
+        original = cls.__dict__[method]
+        func = original.__func__ if isinstance(original, classmethod) else original
+        profiler = self
+        def profiled(obj, *args):
+            start = time.perf_counter()
+            try:
+                return func(obj, *args)
+            finally:
+                profiler.add(key(obj, *args), time.perf_counter() - start)
+        self.originals.append((cls, method, original))
+        setattr(cls, method, classmethod(profiled) if isinstance(original, classmethod) else profiled)
+
+    def enable(self):
+        if field_profiler_t.active != None:
+            raise Exception('another field profiler is enabled')
+        name = lambda obj: type(obj).__name__
+        self.wrap(basedataclass, 'get_field_len', lambda obj, x, data=None: (name(obj), x.name, 'len'))
+        self.wrap(basedataclass, 'pack_field', lambda obj, x: (name(obj), x.name, 'pack'))
+        self.wrap(basedataclass, 'pack_bitfields', lambda obj, bitfields: (name(obj), bitfield_names(bitfields), 'pack'))
+        self.wrap(basedataclass, 'unpack_bitfields', lambda obj, bitfields, data: (name(obj), bitfield_names(bitfields), 'unpack'))
+        self.wrap(basedataclass, 'pack_into', lambda obj, buf: (name(obj), '*', 'pack'))
+        self.wrap(basedataclass, 'unpack1', lambda obj, data: (name(obj), '*', 'unpack'))
+        for cls in [base_int, int_array, bit_array]:
+            self.wrap(cls, 'from_bytes', lambda t, data, *args: (t.__name__, '*', 'from_bytes'))
+        self.wrap(sdp_data_element_t, 'decode', lambda obj, data: (name(obj), '*', 'unpack'))
+        self.wrap(sdp_data_element_t, 'to_bytes', lambda obj: (name(obj), '*', 'pack'))
+        field_profiler_t.active = self
+        return self
+
+    def disable(self):
+        for cls, method, func in self.originals[::-1]:
+            setattr(cls, method, func)
+        self.originals = []
+        if field_profiler_t.active == self:
+            field_profiler_t.active = None
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *exc):
+        self.disable()
+        return False
+
+    def reset(self):
+        self.stats = {}
+
+    def dump(self):
+        # list of (class, field, operation, calls, seconds), most expensive first
+        rows = [key + tuple(value) for key, value in self.stats.items()]
+        return sorted(rows, key=lambda row: row[4], reverse=True)
+
+    def report(self, limit=None):
+        lines = ['{:<24} {:<24} {:<8} {:>10} {:>12} {:>10}'.format('class', 'field', 'op', 'calls', 'total(us)', 'per call')]
+        for cls, field, op, calls, seconds in self.dump()[0:limit]:
+            lines.append('{:<24} {:<24} {:<8} {:>10} {:>12.1f} {:>10.3f}'.format(
+                cls, field, op, calls, seconds * 1e6, seconds * 1e6 / calls))
+        return '\r\n'.join(lines)
+
+def decode_first(classes, data):
+    # decode data as the first class of classes it matches, None if no one matches
+    for cls in classes:
+        value = cls().unpack(data)
+        if value != None:
+            return value
+    return None
+
+class decode_pipeline_t():
+    # asyncio stage decoding framed chunks in order. A chunk up to inline_limit bytes is decoded on
+    # the event loop, the loop is yielded once inline decoding took budget seconds, a larger chunk
+    # is decoded in executor (default executor if None). At most max_pending chunks are queued
+    # for decoding and max_pending decoded ones wait for get().
+    # With a thread pool executor the decoder runs in several threads at once: decode caches and
+    # field_profiler_t are locked, any other state shared by decoder shall be thread safe too,
+    # otherwise use a ProcessPoolExecutor (decode_first with module level classes can be pickled).
+    # Usage: await pipeline.put(chunk) ... result = await pipeline.get() or async for result in pipeline
+    CLOSED = object()
+
+    def __init__(self, classes=None, decoder=None, inline_limit=512, budget=0.002, max_pending=64, executor=None):
+        if decoder == None:
+            decoder = functools.partial(decode_first, tuple(classes))
+        self.decoder = decoder
+        self.inline_limit = inline_limit
+        self.budget = budget
+        self.executor = executor
+        self.input = asyncio.Queue(max_pending)
+        self.output = asyncio.Queue(max_pending)
+        self.worker = None
+        self.start_time = None
+        self.stats = {'decoded':0, 'inline':0, 'offloaded':0, 'errors':0, 'bytes':0,
+                      'latency_total':0.0, 'latency_max':0.0, 'inline_time_max':0.0}
+
+    def start(self):
+        if self.worker == None:
+            self.start_time = time.perf_counter()
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+        return self
+
+    async def put(self, data):
+        self.start()
+        await self.input.put((data, time.perf_counter()))
+
+    async def close(self):
+        # no more input, get() returns CLOSED once everything is decoded
+        self.start()
+        await self.input.put(None)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        slice_start = time.perf_counter()
+        while True:
+            item = await self.input.get()
+            if item == None:
+                await self.output.put(None)
+                return
+            data, enqueued = item
+            n = 0
+            try:
+                n = len(data)
+                if n <= self.inline_limit:
+                    future = loop.create_future()
+                    start = time.perf_counter()
+                    try:
+                        future.set_result(self.decoder(data))
+                    except Exception as e:
+                        future.set_exception(e)
+                    now = time.perf_counter()
+                    self.stats['inline'] += 1
+                    self.stats['inline_time_max'] = max(self.stats['inline_time_max'], now - start)
+                    if now - slice_start >= self.budget:
+                        await asyncio.sleep(0)
+                        slice_start = time.perf_counter()
+                else:
+                    future = loop.run_in_executor(self.executor, self.decoder, data)
+                    self.stats['offloaded'] += 1
+            except Exception as e:
+                # the chunk fails in get(), the worker goes on
+                future = loop.create_future()
+                future.set_exception(e)
+            await self.output.put((future, enqueued, n))
+            if self.input.empty():
+                slice_start = time.perf_counter()
+
+    async def get(self):
+        item = await self.output.get()
+        if item == None:
+            await self.output.put(None) # later get() returns CLOSED too
+            return self.CLOSED
+        future, enqueued, n = item
+        try:
+            result = await future
+        except Exception:
+            self.stats['errors'] += 1
+            raise
+        latency = time.perf_counter() - enqueued
+        self.stats['decoded'] += 1
+        self.stats['bytes'] += n
+        self.stats['latency_total'] += latency
+        self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+        return result
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        result = await self.get()
+        if result is self.CLOSED:
+            raise StopAsyncIteration
+        return result
+
+    def metrics(self):
+        stats = dict(self.stats)
+        elapsed = time.perf_counter() - self.start_time if self.start_time != None else 0
+        stats['throughput'] = stats['decoded'] / elapsed if elapsed else 0.0
+        stats['latency_avg'] = stats['latency_total'] / stats['decoded'] if stats['decoded'] else 0.0
+        return stats
+
+# acl packet boundary flag
+class acl_pb_flag_t(IntEnum):
+    FIRST_NON_FLUSHABLE = 0
+    CONTINUING = 1
+    FIRST_FLUSHABLE = 2
+    COMPLETE = 3
+
+@dataclass
+class acl_header_t(basedataclass):
+    handle: uint12 = None
+    pb_flag: uint2 = None
+    bc_flag: uint2 = None
+    hci_length: uint16 = None
+
+@dataclass
+class l2cap_header_t(basedataclass):
+    l2c_length: uint16 = None
+    cid: uint16 = None
+
+@dataclass
+class l2cap_frame_t(basedataclass):
+    l2c_length: uint16 = dataclasses.field(default=None, metadata={DATA_FIELD:'payload'})
+    cid: uint16 = None
+    payload: bytearray = dataclasses.field(default_factory=bytearray, metadata={LENGTH_FIELD:'l2c_length'})
+
+ACL_HEADER_SIZE = 4
+L2CAP_HEADER_SIZE = 4
+
+class acl_channel_t():
+    # reassembly state of one connection handle
+    def __init__(self, handle, start_time):
+        self.handle = handle
+        self.start_time = start_time
+        self.buffer = bytearray(L2CAP_HEADER_SIZE) # grown to full frame size once l2c_length is known
+        self.filled = 0
+        self.expected = None
+
+class acl_reassembler_t():
+    # Reassemble L2CAP frames from ACL fragments, keyed by connection handle.
+    # Memory is bounded by max_channels partial frames of at most max_frame_size bytes each,
+    # partial frames older than timeout seconds are dropped.
+    def __init__(self, max_channels=16, max_frame_size=65535+L2CAP_HEADER_SIZE, timeout=2.0,
+                 frame_class=l2cap_frame_t, clock=time.monotonic):
+        self.max_channels = max_channels
+        self.max_frame_size = max_frame_size
+        self.timeout = timeout
+        self.frame_class = frame_class
+        self.clock = clock
+        self.channels = {}
+        self.acl_header = acl_header_t()
+        self.l2cap_header = l2cap_header_t()
+        self.stats = {'fragments':0, 'frames':0, 'dropped':0, 'timeouts':0, 'evicted':0, 'errors':0}
+
+    def feed(self, data, now=None):
+        # feed one ACL packet (header included), return completed frame or None
+        if now == None:
+            now = self.clock()
+        self.stats['fragments'] += 1
+        if len(data) < ACL_HEADER_SIZE or self.acl_header.unpack(data) == None:
+            self.stats['errors'] += 1
+            return None
+        header = self.acl_header
+        payload = memoryview(data)[ACL_HEADER_SIZE:ACL_HEADER_SIZE+header.hci_length]
+        if len(payload) != header.hci_length:
+            self.stats['errors'] += 1
+            return None
+
+        if header.pb_flag == acl_pb_flag_t.CONTINUING:
+            channel = self.channels.get(header.handle)
+            if channel == None:
+                self.stats['dropped'] += 1
+                return None
+            if now - channel.start_time > self.timeout:
+                del self.channels[header.handle]
+                self.stats['timeouts'] += 1
+                return None
+        else:
+            if header.handle in self.channels:
+                # a new start fragment aborts the pending frame
+                del self.channels[header.handle]
+                self.stats['dropped'] += 1
+            if len(self.channels) >= self.max_channels:
+                self.expire(now)
+            if len(self.channels) >= self.max_channels:
+                oldest = min(self.channels.values(), key=lambda c: c.start_time)
+                del self.channels[oldest.handle]
+                self.stats['evicted'] += 1
+            channel = acl_channel_t(header.handle, now)
+            self.channels[header.handle] = channel
+        return self.append(channel, payload)
+
+    def append(self, channel, payload):
+        n = len(payload)
+        if channel.expected == None:
+            # l2cap header may be split across fragments
+            m = min(n, L2CAP_HEADER_SIZE - channel.filled)
+            channel.buffer[channel.filled:channel.filled+m] = payload[0:m]
+            channel.filled += m
+            payload = payload[m:]
+            n -= m
+            if channel.filled < L2CAP_HEADER_SIZE:
+                return None
+            self.l2cap_header.unpack(channel.buffer)
+            channel.expected = L2CAP_HEADER_SIZE + self.l2cap_header.l2c_length
+            if channel.expected > self.max_frame_size:
+                del self.channels[channel.handle]
+                self.stats['dropped'] += 1
+                return None
+            channel.buffer.extend(bytes(channel.expected - L2CAP_HEADER_SIZE))
+
+        if channel.filled + n > channel.expected:
+            del self.channels[channel.handle]
+            self.stats['errors'] += 1
+            return None
+        channel.buffer[channel.filled:channel.filled+n] = payload
+        channel.filled += n
+        if channel.filled < channel.expected:
+            return None
+
+        del self.channels[channel.handle]
+        frame = self.frame_class().unpack(channel.buffer)
+        if frame == None:
+            self.stats['errors'] += 1
+            return None
+        self.stats['frames'] += 1
+        return frame
+
+    def expire(self, now=None):
+        # drop partial frames older than timeout, return number of dropped frames
+        if now == None:
+            now = self.clock()
+        stale = [h for h, c in self.channels.items() if now - c.start_time > self.timeout]
+        for h in stale:
+            del self.channels[h]
+        self.stats['timeouts'] += len(stale)
+        return len(stale)
+
+    def reset(self):
+        self.channels.clear()
+
 #------------------------ unit test -------------------------------- 
 @dataclass
 class s_with_length_field(basedataclass):
@@ -822,6 +1908,35 @@ class s_with_bitfield(basedataclass):
     pb_flag: uint2 = None
     bc_flag: uint2 = None
     tail: uint8 = None
+
+@dataclass
+class s_with_nested_field(basedataclass):
+    length: uint8 = dataclasses.field(default=None, metadata={DATA_FIELD:'frame'})
+    frame: l2cap_frame_t = dataclasses.field(default_factory=l2cap_frame_t, metadata={LENGTH_FIELD:'length'})
+
+@dataclass
+class s_with_bitfield_length(basedataclass):
+    handle: uint16 = None
+    length: uint14 = dataclasses.field(default=None, metadata={DATA_FIELD:'data'})
+    rfu: uint2 = 0
+    data: bytearray = dataclasses.field(default_factory=bytearray, metadata={LENGTH_FIELD:'length'})
+
+@dataclass
+class s_with_length_offset(basedataclass):
+    length: uint8 = dataclasses.field(default=None, metadata={DATA_FIELD:'data'})
+    data: bytearray = dataclasses.field(default_factory=bytearray, metadata={LENGTH_FIELD:'length', LENGTH_OFFSET:1})
+
+@dataclass
+class s_with_packed_identity(l2cap_frame_t):
+    pass
+
+@dataclass
+class s_with_bit_array(basedataclass):
+    channel_map: uint1_array = dataclasses.field(default_factory=uint1_array, metadata={LENGTH_FIELD:5})
+    samples: uint12_array = dataclasses.field(default_factory=uint12_array, metadata={LENGTH_FIELD:3})
+    flags: uint3_array = dataclasses.field(default_factory=uint3_array, metadata={LENGTH_FIELD:2, ITEM_COUNT:3})
+    n_levels: uint8 = None
+    levels: uint5_array = dataclasses.field(default_factory=uint5_array, metadata={ITEM_COUNT:'n_levels'})
    
 def test_length_field():
     d = s_with_length_field(data=b'\x01\x02')
@@ -882,10 +1997,315 @@ def test_bitfield():
     else:
         print('test_bitfield fail\r\n')
 
+def test_pack_length_fixup():
+    d = s_with_union_field(cid=0x0040, l2c_data=b'\x01')
+    d.l2c_data = bytearray(b'\x01\x02\x03')
+    data = d.pack()
+    print(hexlify(data))
+    d2 = s_with_union_field().unpack(data)
+
+    n = s_with_nested_field(frame=l2cap_frame_t(cid=0x0040, payload=b'\x01'))
+    n.frame.payload = bytearray(b'\x01\x02')
+    data = n.pack()
+    print(hexlify(data))
+    n2 = s_with_nested_field().unpack(data)
+
+    b = s_with_bitfield_length(handle=1, data=b'abc')
+    b.data += b'de'
+    bdata = b.pack()
+    b2 = s_with_bitfield_length().unpack(bdata)
+
+    o = s_with_length_offset(data=b'\x01\x02\x03\x04')
+    o_len = o.length
+    odata = o.pack()
+    o2 = s_with_length_offset().unpack(odata)
+
+    if d2 == d and d.hci_length == 7 and d.l2c_length == 3 and n2 == n and n.length == 6 \
+            and bdata == b'\x01\x00\x05\x00abcde' and b2 == b \
+            and o_len == 3 and o.length == 3 and len(o) == 5 and odata == b'\x03\x01\x02\x03\x04' and o2 == o:
+        print('test_pack_length_fixup pass\r\n')
+    else:
+        print('test_pack_length_fixup fail\r\n')
+
+def test_ctypes_struct():
+    d = s_with_bitfield(head=0, pb_flag=1, bc_flag=2, handle=0x20, tail=255)
+    buf = bytearray(d.pack())
+    c = s_with_bitfield.from_buffer(buf)
+    c.handle = 0x0abc
+    d2 = s_with_bitfield().unpack(buf)
+    print('{} {}'.format(s_with_bitfield.struct_format(), s_with_int_array.struct_format()))
+
+    a = s_with_int_array(array8=[0x01, 0x02], array16=[0x0001, 0x0002], array32=[0x00000001])
+    c2 = s_with_int_array.ctypes_struct().from_buffer_copy(a.pack())
+    if ctypes.sizeof(c) == len(d) and c.pb_flag == 1 and c.bc_flag == 2 and c.tail == 255 and d2.handle == 0x0abc \
+            and list(c2.array16) == [1, 2] and s_with_bitfield.struct_format() == '<BHB' \
+            and struct.unpack(s_with_int_array.struct_format(), a.pack()) == (1, 2, 1, 2, 1):
+        print('test_ctypes_struct pass\r\n')
+    else:
+        print('test_ctypes_struct fail\r\n')
+
+def test_packed_identity():
+    s_with_packed_identity.enable_packed_identity()
+    a = s_with_packed_identity(cid=0x0040, payload=b'\x01')
+    b = s_with_packed_identity().unpack(a.pack())
+    c = s_with_packed_identity(cid=0x0041, payload=b'\x01')
+    s = {a, b, c}
+    c.cid = 0x0040
+    frames = list(dedup([a, b, c, s_with_length_field(data=b'\x01')]))
+    e = s_with_packed_identity()
+    unset_ok = (a == e) == False and (e in {a}) == False and e == s_with_packed_identity() and e in {a, e}
+    if len(s) == 2 and a == b and hash(a) == hash(b) and c == a and len(frames) == 2 and unset_ok:
+        print('test_packed_identity pass\r\n')
+    else:
+        print('test_packed_identity fail\r\n')
+
+def test_sdp_record_view():
+    def attr(attr_id, value):
+        return [sdp_data_element_t(data_element_type.UINT, 2, attr_id), value]
+    uuid = sdp_data_element_t(data_element_type.UUID, 2, b'\x11\x01')
+    attrs = attr(0x0000, sdp_data_element_t(data_element_type.UINT, 4, 0x00010001)) \
+          + attr(0x0001, sdp_data_element_t(data_element_type.DATA_ELEMENT_SEQ, 3, [uuid])) \
+          + attr(0x0100, sdp_data_element_t(data_element_type.STRING, 300, b'x'*300))
+    size = sum(len(x.to_bytes()) for x in attrs)
+    data = sdp_data_element_t(data_element_type.DATA_ELEMENT_SEQ, size, attrs).to_bytes()
+
+    bad_records = 0
+    # value missing, value overrunning the sequence, truncated attribute id
+    for bad in [b'\x35\x03\x09\x00\x01', b'\x35\x05\x09\x00\x01\x09\x00\x01', b'\x35\x02\x09\x00']:
+        try:
+            sdp_record_view_t(bad).build_index()
+            bad_records += 1
+        except Exception as e:
+            print(e)
+
+    v = sdp_record_view_t(data)
+    print('attributes={}'.format(['0x{:04x}'.format(x) for x in v.attribute_ids()]))
+    if v.get(0x0000).element_data == 0x00010001 and v[0x0001].element_data[0].element_data == b'\x11\x01' \
+            and len(v[0x0100].element_data) == 300 and 0x0200 not in v and len(v) == 3 \
+            and bad_records == 0:
+        print('test_sdp_record_view pass\r\n')
+    else:
+        print('test_sdp_record_view fail\r\n')
+
+def test_field_profiler():
+    original = basedataclass.unpack1
+    original_from_bytes = base_int.__dict__['from_bytes'].__func__
+    data = s_with_bitfield(head=0, pb_flag=1, bc_flag=2, handle=0x20, tail=255).pack()
+    with field_profiler_t() as prof:
+        for i in range(10):
+            s_with_bitfield().unpack(data)
+    print(prof.report(limit=5))
+    stats = prof.stats
+    if stats[('s_with_bitfield', '*', 'unpack')][0] == 10 and stats[('s_with_bitfield', 'handle+pb_flag+bc_flag', 'unpack')][0] == 10 \
+            and stats[('uint8', '*', 'from_bytes')][0] == 20 and basedataclass.unpack1 is original \
+            and base_int.__dict__['from_bytes'].__func__ is original_from_bytes:
+        print('test_field_profiler pass\r\n')
+    else:
+        print('test_field_profiler fail\r\n')
+
+def test_decode_pipeline():
+    small = s_with_length_field(data=b'\x01\x02').pack()
+    large = s_with_length_field(data=bytes(100)).pack()
+    chunks = [small, large, b'', small, large]
+
+    async def run():
+        pipeline = decode_pipeline_t(classes=[s_with_length_field], inline_limit=16, max_pending=2)
+        async def producer():
+            for chunk in chunks:
+                await pipeline.put(chunk)
+            await pipeline.close()
+        task = asyncio.get_running_loop().create_task(producer())
+        results = [x async for x in pipeline]
+        await task
+        return results, pipeline.metrics()
+
+    async def run_errors():
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        executor.shutdown()
+        pipeline = decode_pipeline_t(classes=[s_with_length_field], inline_limit=16, executor=executor)
+        for chunk in [None, large, small]:
+            await pipeline.put(chunk)
+        await pipeline.close()
+        results = []
+        while True:
+            try:
+                result = await pipeline.get()
+            except Exception as e:
+                result = type(e)
+            if result is decode_pipeline_t.CLOSED:
+                return results
+            results.append(result)
+
+    errors = asyncio.run(run_errors())
+    results, metrics = asyncio.run(run())
+    print('metrics={}'.format(metrics))
+    if [len(x.data) if x != None else None for x in results] == [2, 100, None, 2, 100] \
+            and metrics['offloaded'] == 2 and metrics['decoded'] == 5 \
+            and errors[0] == TypeError and errors[1] == RuntimeError and len(errors[2].data) == 2:
+        print('test_decode_pipeline pass\r\n')
+    else:
+        print('test_decode_pipeline fail\r\n')
+
+def test_signed_int():
+    @dataclass
+    class s_with_signed_field(basedataclass):
+        a: int8 = None
+        b: int16 = None
+        c: int24 = None
+        d: uint16_be = None
+    d = s_with_signed_field(a=-1, b=-2, c=-3, d=0x1234)
+    data = d.pack()
+    print(hexlify(data))
+    d2 = s_with_signed_field().unpack(data)
+    if d2 == d and d2.c == -3 and type(d2.c) == int24 and data == b'\xff\xfe\xff\xfd\xff\xff\x12\x34' \
+            and int16.from_bytes(b'\x00\x80') == -32768 and uint16.from_bytes(b'\x00\x80') == 0x8000:
+        print('test_signed_int pass\r\n')
+    else:
+        print('test_signed_int fail\r\n')
+
+def test_bit_array():
+    d = s_with_bit_array(channel_map=[1, 0, 1, 1]*9 + [0]*4, samples=[0xabc, 0x123], flags=[1, 2, 3],
+                         n_levels=5, levels=[31, 0, 17, 4, 9])
+    print('{}, len={}'.format(d, len(d)))
+    data = d.pack()
+    print(hexlify(data))
+
+    d2 = s_with_bit_array().unpack(data)
+    print('{}, len={}'.format(d2, len(d2)))
+
+    a = uint12_array(list(range(0, 4000, 7)))
+    a[3] = 0xfff
+
+    # item count field is filled in from the array, at construction and at pack time
+    c = s_with_bit_array(channel_map=[0]*40, samples=[0, 0], flags=[0, 0, 0], levels=[31, 0, 17])
+    c_n_levels = c.n_levels
+    c.levels = uint5_array([1, 2])
+    c2 = s_with_bit_array().unpack(c.pack())
+    m = s_with_bit_array(channel_map=[0]*40, samples=[0, 0], flags=[0, 0, 0], n_levels=5, levels=[31, 0, 17])
+
+    if d2 == d and d2.samples[1] == 0x123 and d2.flags.array == [1, 2, 3] and d2.levels.array == [31, 0, 17, 4, 9] \
+            and len(data) == 15 and a[3] == 0xfff and a[4] == 28 and a.array[-1] == 3997 \
+            and c_n_levels == 3 and c.n_levels == 2 and c2 == c and m.n_levels == 3:
+        print('test_bit_array pass\r\n')
+    else:
+        print('test_bit_array fail\r\n')
+
+def test_bit_array_numpy():
+    global BIT_ARRAY_NUMPY_THRESHOLD
+    if numpy == None:
+        print('test_bit_array_numpy skipped, numpy is not installed\r\n')
+        return
+    threshold = BIT_ARRAY_NUMPY_THRESHOLD
+    ok = True
+    for cls in sorted(bit_array_types, key=lambda c: c.BITS):
+        values = [(i * 2654435761) & ((1 << cls.BITS) - 1) for i in range(threshold + 77)]
+        a = cls(numpy.array(values, dtype=numpy.uint16))
+        BIT_ARRAY_NUMPY_THRESHOLD = len(values) + 1 # pure python path
+        b = cls(values)
+        ok = ok and a.to_bytes() == b.to_bytes() and b.array == values
+        BIT_ARRAY_NUMPY_THRESHOLD = threshold
+        ok = ok and a.array == values
+        # short numpy array and numpy scalars take the pure python path
+        c = cls(numpy.array(values[0:3], dtype=numpy.uint16))
+        ok = ok and c.array == values[0:3] and cls.encode(list(numpy.array(values[0:3], dtype=numpy.uint16))) == c.to_bytes()
+    if ok:
+        print('test_bit_array_numpy pass\r\n')
+    else:
+        print('test_bit_array_numpy fail\r\n')
+
+def test_decode_cache():
+    cache = s_with_length_field.enable_decode_cache(maxsize=2)
+    data = s_with_length_field(data=b'\x01\x02').pack()
+    d1 = s_with_length_field().unpack(data)
+    d1.data[0] = 0xff
+    d2 = s_with_length_field().unpack(data)
+    s_with_length_field().unpack(b'\x01\x03')
+    s_with_length_field().unpack(b'\x01\x04')
+    print('stats={}'.format(cache.stats()))
+    s_with_length_field.disable_decode_cache()
+
+    sdp_data_element_t.enable_decode_cache()
+    seq = sdp_data_element_t(data_element_type.DATA_ELEMENT_SEQ, 6,
+                             [sdp_data_element_t(data_element_type.UINT, 2, 0x0100),
+                              sdp_data_element_t(data_element_type.UUID, 2, b'\x11\x01')]).to_bytes()
+    e1 = sdp_data_element_t()
+    e1.from_bytes(seq)
+    e2 = sdp_data_element_t().from_bytes(seq)
+    try:
+        e2.element_data[0].element_data = 0
+        frozen = False
+    except AttributeError:
+        frozen = True
+    sdp_stats = sdp_data_element_t.decode_cache.stats()
+    sdp_data_element_t.disable_decode_cache()
+
+    if d2.data == b'\x01\x02' and cache.stats() == {'hits':1, 'misses':3, 'evictions':1, 'size':2, 'maxsize':2} \
+            and e1 is not e2 and e1.element_data[0] is e2.element_data[0] and frozen \
+            and e1.element_data[0].element_data == 0x0100 and sdp_stats['size'] == 1 and sdp_stats['hits'] == 1:
+        print('test_decode_cache pass\r\n')
+    else:
+        print('test_decode_cache fail\r\n')
+
+def acl_fragments(handle, frame, mtu):
+    # split a packed l2cap frame into ACL packets of at most mtu payload bytes
+    packets = []
+    offset = 0
+    pb_flag = acl_pb_flag_t.FIRST_FLUSHABLE
+    while offset < len(frame):
+        chunk = frame[offset:offset+mtu]
+        header = acl_header_t(handle=handle, pb_flag=pb_flag, bc_flag=0, hci_length=len(chunk))
+        packets.append(header.pack() + chunk)
+        offset += mtu
+        pb_flag = acl_pb_flag_t.CONTINUING
+    return packets
+
+def test_acl_reassembler():
+    d = l2cap_frame_t(cid=0x0040, payload=bytearray(range(50)))
+    packets = acl_fragments(0x20, d.pack(), 7)
+    r = acl_reassembler_t()
+    frames = [r.feed(p, now=0) for p in packets]
+    print('{} fragments, stats={}'.format(len(packets), r.stats))
+
+    if frames[-1] == d and frames[:-1] == [None]*(len(packets)-1) and len(r.channels) == 0:
+        print('test_acl_reassembler pass\r\n')
+    else:
+        print('test_acl_reassembler fail\r\n')
+
+    r.feed(packets[0], now=0)
+    if r.feed(packets[1], now=r.timeout+1) == None and r.stats['timeouts'] == 1:
+        print('test_acl_reassembler timeout pass\r\n')
+    else:
+        print('test_acl_reassembler timeout fail\r\n')
+
+def bench_acl_reassembler(n_frames=2000, n_handles=8, mtu=27):
+    d = l2cap_frame_t(cid=0x0040, payload=bytearray(200))
+    packets = []
+    for handle in range(n_handles):
+        packets.append(acl_fragments(handle, d.pack(), mtu))
+    # interleave fragments of all handles
+    stream = [p for group in zip(*packets) for p in group] * (n_frames // n_handles)
+    r = acl_reassembler_t(max_channels=n_handles)
+    start = time.perf_counter()
+    for p in stream:
+        r.feed(p)
+    elapsed = time.perf_counter() - start
+    print('{} fragments in {:.3f}s, {:.0f} fragments/s, stats={}'.format(len(stream), elapsed, len(stream)/elapsed, r.stats))
+
 if __name__ == '__main__':
     '''test_length_field()
     test_union_field()   
     test_int_array()'''
     test_bitfield()
+    test_pack_length_fixup()
+    test_bit_array()
+    test_bit_array_numpy()
+    test_ctypes_struct()
+    test_packed_identity()
+    test_sdp_record_view()
+    test_field_profiler()
+    test_decode_pipeline()
+    test_signed_int()
+    test_decode_cache()
+    test_acl_reassembler()
     
     